@@ -1,9 +1,12 @@
 import collections
 import functools
+import itertools
 import logging
 import time
 from typing import Callable, Sequence, Union
 
+from pymongo.write_concern import WriteConcern
+
 from lib.cuckoo.common.config import Config
 
 log = logging.getLogger(__name__)
@@ -20,7 +23,12 @@ if repconf.mongodb.enabled:
     if version_tuple[0] < 4:
         log.warning("You using old version of PyMongo, upgrade: poetry install")
 
+    conn = None
+
     def connect_to_mongo() -> MongoClient:
+        # MongoClient is thread-safe and pools its own connections, reuse the module client once created.
+        if conn is not None:
+            return conn
         try:
             return MongoClient(
                 host=repconf.mongodb.get("host", "127.0.0.1"),
@@ -43,6 +51,9 @@ if repconf.mongodb.enabled:
     conn = connect_to_mongo()
     results_db = conn[mdb]
 
+# Used by reporting for the "calls" collection: lost writes there are acceptable as an analysis can be reported again.
+UNACKNOWLEDGED = WriteConcern(w=0)
+
 MAX_AUTO_RECONNECT_ATTEMPTS = 5
 
 
@@ -109,6 +120,19 @@ def mongo_insert_one(collection: str, doc):
     return getattr(results_db, collection).insert_one(doc)
 
 
+def _get_collection(collection: str, write_concern=None):
+    if write_concern is None:
+        return getattr(results_db, collection)
+    return getattr(results_db, collection).with_options(write_concern=write_concern)
+
+
+@graceful_auto_reconnect
+def mongo_insert_many(collection: str, docs, ordered: bool = True, bypass_document_validation: bool = False, write_concern=None):
+    return _get_collection(collection, write_concern).insert_many(
+        docs, ordered=ordered, bypass_document_validation=bypass_document_validation
+    )
+
+
 @graceful_auto_reconnect
 def mongo_find(collection: str, query, projection=False, sort=None, limit=None):
     if sort is None:
@@ -147,8 +171,8 @@ def mongo_delete_one(collection: str, query):
 
 
 @graceful_auto_reconnect
-def mongo_delete_many(collection: str, query):
-    return getattr(results_db, collection).delete_many(query)
+def mongo_delete_many(collection: str, query, write_concern=None):
+    return _get_collection(collection, write_concern).delete_many(query)
 
 
 @graceful_auto_reconnect
@@ -186,31 +210,48 @@ def mongo_drop_database(database: str):
     conn.drop_database(database)
 
 
-def mongo_delete_data(task_ids: Union[int, Sequence[int]]):
+def mongo_delete_data(task_ids: Union[int, Sequence[int]], calls_write_concern=None) -> bool:
+    """Delete the analyses of the given task ids and their call chunks.
+    calls_write_concern is only meant to be relaxed by callers that can redo the
+    work, like reporting, as lost deletes leave the call chunks behind for good.
+    Returns True if any analysis was found and deleted.
+    """
     try:
         if isinstance(task_ids, int):
             task_ids = [task_ids]
 
         analyses_tmp = []
         found_task_ids = []
-        tasks = mongo_find("analysis", {"info.id": {"$in": task_ids}}, {"behavior.processes.calls": 1, "info.id": 1})
-
-        for task in tasks or []:
-            for process in task.get("behavior", {}).get("processes", []):
-                if process.get("calls"):
-                    mongo_delete_many("calls", {"_id": {"$in": process["calls"]}})
+        call_ids = []
+        # The denormalize_files_from_reports hook on "analysis" already returns a list,
+        # list() only guards against getting a bare cursor back if that ever changes.
+        tasks = list(mongo_find("analysis", {"info.id": {"$in": task_ids}}, {"behavior.processes.calls": 1, "info.id": 1}) or [])
+        if not tasks:
+            return False
+
+        for task in tasks:
+            call_ids.extend(
+                itertools.chain.from_iterable(
+                    process.get("calls") or [] for process in task.get("behavior", {}).get("processes", []) or []
+                )
+            )
             analyses_tmp.append(task["_id"])
             task_id = task.get("info", {}).get("id", None)
             if task_id is not None:
                 found_task_ids.append(task_id)
 
+        if call_ids:
+            mongo_delete_many("calls", {"_id": {"$in": call_ids}}, write_concern=calls_write_concern)
+
         if analyses_tmp:
             mongo_delete_many("analysis", {"_id": {"$in": analyses_tmp}})
             if found_task_ids:
                 for hook in hooks[mongo_delete_data]["analysis"]:
                     hook(found_task_ids)
+        return True
     except Exception as e:
         log.error(e, exc_info=True)
+    return False
 
 
 def mongo_is_cluster():
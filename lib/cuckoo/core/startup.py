@@ -99,6 +99,8 @@ def check_webgui_mongo():
         # with large amounts of data.
         # Note: Silently ignores the creation if the index already exists.
         mongo_create_index("analysis", "info.id", name="info.id_1")
+        # No hash indexes on analysis: the sha256 searches in web_utils are $or queries over
+        # every *.sha256 and *.file_ref path, and $or only uses indexes when all clauses have one.
         # mongo_create_index([("target.file.sha256", TEXT)], name="target_sha256")
         # We performs a lot of SHA256 hash lookup so we need this index
         # mongo_create_index(
@@ -2,7 +2,7 @@
 # This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
 # See the file 'docs/LICENSE' for copying permission.
 
-import gc
+import concurrent.futures
 import logging
 
 from lib.cuckoo.common.abstracts import Report
@@ -10,9 +10,18 @@ from lib.cuckoo.common.exceptions import CuckooDependencyError, CuckooReportErro
 from modules.reporting.report_doc import ensure_valid_utf8, get_json_document, insert_calls
 
 try:
-    from pymongo.errors import InvalidDocument, OperationFailure
+    import bson
+    from pymongo import UpdateOne
+    from pymongo.errors import BulkWriteError, InvalidDocument, OperationFailure
 
-    from dev_utils.mongodb import mongo_collection_names, mongo_delete_data, mongo_find_one, mongo_insert_one, mongo_update_one
+    from dev_utils.mongodb import (
+        UNACKNOWLEDGED,
+        mongo_bulk_write,
+        mongo_collection_names,
+        mongo_delete_data,
+        mongo_find_one,
+        mongo_insert_one,
+    )
 
     HAVE_MONGO = True
 except ImportError:
@@ -23,6 +32,43 @@ MEGABYTE = 0x100000
 
 log = logging.getLogger(__name__)
 
+CONTAINER_TYPES = (dict, list, tuple, set)
+
+
+def _size_of(obj, memo):
+    """Returns the total length of the strings under obj.
+    The size of every container walked is cached in memo by id(), so
+    repeated calls over the same report only walk new subtrees.
+    """
+    if isinstance(obj, str):
+        return len(obj)
+    if not isinstance(obj, CONTAINER_TYPES):
+        return 0
+
+    # Post-order walk with an explicit stack, reports can be nested deeper than the recursion limit.
+    stack = [(obj, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if id(node) in memo:
+            continue
+        children = node.values() if isinstance(node, dict) else node
+        if expanded:
+            memo[id(node)] = sum(
+                len(child) if isinstance(child, str) else memo[id(child)] if isinstance(child, CONTAINER_TYPES) else 0
+                for child in children
+            )
+        else:
+            stack.append((node, True))
+            stack.extend((child, False) for child in children if isinstance(child, CONTAINER_TYPES))
+
+    return memo[id(obj)]
+
+
+def _encoded_size(key, value):
+    """Returns the number of bytes key and value take in a BSON document."""
+    # Strip the document length and terminator added around the single element.
+    return len(bson.encode({key: value})) - 5
+
 
 class MongoDB(Report):
     """Stores report in MongoDB."""
@@ -32,58 +78,125 @@ class MongoDB(Report):
     # Mongo schema version, used for data migration.
     SCHEMA_VERSION = "1"
 
-    def debug_dict_size(self, dct):
+    # Set once the schema version has been checked by this process.
+    _initialized = False
+
+    def debug_dict_size(self, dct, memo=None):
         if isinstance(dct, list):
             dct = dct[0]
 
-        totals = dict((k, 0) for k in dct)
-
-        def walk(root, key, val):
-            if isinstance(val, dict):
-                for k, v in val.items():
-                    walk(root, k, v)
-
-            elif isinstance(val, (list, tuple, set)):
-                for el in val:
-                    walk(root, None, el)
+        if memo is None:
+            memo = {}
 
-            elif isinstance(val, str):
-                totals[root] += len(val)
-
-        for key, val in dct.items():
-            walk(key, key, val)
+        totals = dict((k, _size_of(v, memo)) for k, v in dct.items())
 
         return sorted(list(totals.items()), key=lambda item: item[1], reverse=True)
 
     # use this function to hunt down non string key
     def fix_int2str(self, dictionary, current_key_tree=""):
-        for k, v in dictionary.iteritems():
-            if not isinstance(k, str):
-                log.error("BAD KEY: %s", ".".join([current_key_tree, str(k)]))
-                dictionary[str(k)] = dictionary.pop(k)
-            elif isinstance(v, dict):
-                self.fix_int2str(v, ".".join([current_key_tree, k]))
-            elif isinstance(v, list):
-                for d in v:
-                    if isinstance(d, dict):
-                        self.fix_int2str(d, ".".join([current_key_tree, k]))
+        stack = [(current_key_tree, dictionary)]
+        while stack:
+            key_tree, dct = stack.pop()
+            # Keys can be renamed below, so iterate over a snapshot.
+            for k in list(dct.keys()):
+                v = dct[k]
+                if not isinstance(k, str):
+                    log.error("BAD KEY: %s", ".".join([key_tree, str(k)]))
+                    dct[str(k)] = dct.pop(k)
+                    k = str(k)
+                if isinstance(v, dict):
+                    stack.append((".".join([key_tree, k]), v))
+                elif isinstance(v, list):
+                    stack.extend((".".join([key_tree, k]), d) for d in v if isinstance(d, dict))
 
-    def loop_saver(self, report):
-        keys = list(report.keys())
-        if "info" not in keys:
-            log.error("Missing 'info' key: %s", keys)
+    def shrink_report(self, report, memo):
+        """Deletes the largest child keys of the report until its BSON encoding fits in MONGOSIZELIMIT.
+        @param report: report dictionary, modified in place.
+        @param memo: subtree sizes cache, see _size_of.
+        """
+        # Document length and terminator, plus every top-level element.
+        doc_size = 5 + sum(_encoded_size(k, v) for k, v in report.items())
+        if doc_size <= MONGOSIZELIMIT:
             return
-        if "_id" in keys:
-            keys.remove("_id")
 
-        obj_id = mongo_insert_one("analysis", {"info": report["info"]}).inserted_id
-        keys.remove("info")
+        # (size, container, key, parent_key), deleting container[key] removes that candidate.
+        candidates = []
+        # deepcopy keeps shared references, the same dict can show up several times in a list.
+        seen = set()
+
+        def add_candidates(container, parent_key):
+            if id(container) in seen:
+                return
+            seen.add(id(container))
+            candidates.extend((_size_of(v, memo), container, k, parent_key) for k, v in container.items())
+
+        for parent_key, parent in report.items():
+            if parent_key == "info":
+                continue
+            if parent_key == "strings" and isinstance(parent, list):
+                candidates.append((_size_of(parent, memo), report, parent_key, None))
+            elif isinstance(parent, dict):
+                add_candidates(parent, parent_key)
+            elif isinstance(parent, list):
+                for parent_dict in parent:
+                    if isinstance(parent_dict, dict):
+                        add_candidates(parent_dict, parent_key)
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+        plan = []
+        for candidate in candidates:
+            if doc_size <= MONGOSIZELIMIT:
+                break
+            _, container, key, _ = candidate
+            doc_size -= _encoded_size(key, container[key])
+            plan.append(candidate)
 
-        for key in keys:
+        for size, container, key, parent_key in plan:
+            if parent_key is None:
+                log.warning("results['%s'] deleted due to size: %s", key, size)
+            else:
+                log.warning("results['%s']['%s'] deleted due to size: %s", parent_key, key, size)
+            del container[key]
+
+    def loop_saver(self, report):
+        if "info" not in report:
+            log.error("Missing 'info' key: %s", list(report))
+            return
+
+        # Keep out only the keys that can't be encoded at all, so everything else goes in one round-trip.
+        doc = {"info": report["info"]}
+        for key in (k for k in report if k not in ("info", "_id")):
             try:
-                mongo_update_one("analysis", {"_id": obj_id}, {"$set": {key: report[key]}}, bypass_document_validation=True)
+                bson.encode({key: report[key]})
             except InvalidDocument:
                 log.warning("Investigate your key: %s", key)
+                continue
+            doc[key] = report[key]
+
+        try:
+            mongo_insert_one("analysis", doc)
+            return
+        except InvalidDocument as e:
+            log.warning("Failed to store report in one document, storing it key by key: %s", e)
+
+        obj_id = mongo_insert_one("analysis", {"info": report["info"]}).inserted_id
+        set_keys = [key for key in doc if key not in ("info", "_id")]
+        if not set_keys:
+            return
+        requests = [UpdateOne({"_id": obj_id}, {"$set": {key: doc[key]}}) for key in set_keys]
+        try:
+            mongo_bulk_write("analysis", requests, ordered=False, bypass_document_validation=True)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                log.warning("Investigate your key: %s", set_keys[error["index"]])
+        except InvalidDocument as e:
+            # Raised client side for the whole batch (e.g. DocumentTooLarge), so find the culprits one by one.
+            log.warning("Failed to store report keys in one batch, storing them one by one: %s", e)
+            for key, request in zip(set_keys, requests):
+                try:
+                    mongo_bulk_write("analysis", [request], bypass_document_validation=True)
+                except (BulkWriteError, InvalidDocument):
+                    log.warning("Investigate your key: %s", key)
 
     def run(self, results):
         """Writes report.
@@ -95,14 +208,15 @@ class MongoDB(Report):
         if not HAVE_MONGO:
             raise CuckooDependencyError("Unable to import pymongo (install with `pip3 install pymongo`)")
 
-        # move to startup
-        # Set mongo schema version.
-        # TODO: This is not optimal because it run each analysis. Need to run only one time at startup.
-        if "cuckoo_schema" in mongo_collection_names():
-            if mongo_find_one("cuckoo_schema", {}, {"version": 1})["version"] != self.SCHEMA_VERSION:
-                CuckooReportError("Mongo schema version not expected, check data migration tool")
-        else:
-            mongo_insert_one("cuckoo_schema", {"version": self.SCHEMA_VERSION})
+        # Set mongo schema version, only once per process.
+        # Indexes are created at startup, see lib.cuckoo.core.startup.check_webgui_mongo.
+        if not MongoDB._initialized:
+            if "cuckoo_schema" in mongo_collection_names():
+                if mongo_find_one("cuckoo_schema", {}, {"version": 1})["version"] != self.SCHEMA_VERSION:
+                    CuckooReportError("Mongo schema version not expected, check data migration tool")
+            else:
+                mongo_insert_one("cuckoo_schema", {"version": self.SCHEMA_VERSION})
+            MongoDB._initialized = True
 
         # Create a copy of the dictionary. This is done in order to not modify
         # the original dictionary and possibly compromise the following
@@ -112,20 +226,22 @@ class MongoDB(Report):
         if "network" not in report:
             report["network"] = {}
 
-        new_processes = insert_calls(report, mongodb=True)
-        # Store the results in the report.
-        report["behavior"] = dict(report["behavior"])
-        report["behavior"]["processes"] = new_processes
-
         # trick for distributed api
-        if results.get("info", {}).get("options", {}).get("main_task_id", ""):
-            report["info"]["id"] = int(results["info"]["options"]["main_task_id"])
+        task_id = int(results.get("info", {}).get("options", {}).get("main_task_id") or report["info"]["id"])
+        report["info"]["id"] = task_id
 
-        mongo_delete_data(int(report["info"]["id"]))
-        log.debug("Deleted previous MongoDB data for Task %s", report["info"]["id"])
+        # Both are I/O bound and independent: the previous data of this task
+        # is deleted while the new call chunks are being inserted.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            deleted = executor.submit(mongo_delete_data, task_id, calls_write_concern=UNACKNOWLEDGED)
+            new_processes = insert_calls(report, mongodb=True)
+        # Store the results in the report, get_json_document already returned a deep copy.
+        report["behavior"]["processes"] = new_processes
+
+        if deleted.result():
+            log.debug("Deleted previous MongoDB data for Task %s", task_id)
 
         ensure_valid_utf8(report)
-        gc.collect()
 
         # Store the report and retrieve its object id.
         try:
@@ -145,45 +261,18 @@ class MongoDB(Report):
             if str(e).startswith("cannot encode object") or str(e).endswith("must not contain '.'"):
                 self.loop_saver(report)
                 return
-            parent_key, psize = self.debug_dict_size(report)[0]
+            # Subtree sizes are cached, the shrinking plan reuses them.
+            memo = {}
+            parent_key, psize = self.debug_dict_size(report, memo)[0]
             log.warning("Largest parent key: %s (%d MB)", parent_key, int(psize) // MEGABYTE)
             if self.options.get("fix_large_docs"):
-                # Delete the problem keys and check for more
-                error_saved = True
-                size_filter = MONGOSIZELIMIT
-                while error_saved:
-                    if isinstance(report, list):
-                        report = report[0]
-                    try:
-                        if isinstance(report[parent_key], list):
-                            if parent_key == "strings":
-                                del report["strings"]
-                                parent_key, psize = self.debug_dict_size(report)[0]
-                                continue
-                            else:
-                                for j, parent_dict in enumerate(report[parent_key]):
-                                    child_key, csize = self.debug_dict_size(parent_dict)[0]
-                                    if csize > size_filter:
-                                        log.warn("results['%s']['%s'] deleted due to size: %s", parent_key, child_key, csize)
-                                        del report[parent_key][j][child_key]
-                        else:
-                            child_key, csize = self.debug_dict_size(report[parent_key])[0]
-                            if csize > size_filter:
-                                log.warn("results['%s']['%s'] deleted due to size: %s", parent_key, child_key, csize)
-                                del report[parent_key][child_key]
-                        try:
-                            mongo_insert_one("analysis", report)
-                            error_saved = False
-                        except InvalidDocument as e:
-                            if str(e).startswith("documents must have only string keys"):
-                                log.error("Search bug in your modifications - you got an dictionary key as int, should be string")
-                                log.error(str(e))
-                                return
-                            else:
-                                parent_key, psize = self.debug_dict_size(report)[0]
-                                log.error(str(e))
-                                log.warning("Largest parent key: %s (%d MB)", parent_key, int(psize) // MEGABYTE)
-                                size_filter -= MEGABYTE
-                    except Exception as e:
-                        log.error("Failed to delete child key: %s", e)
-                        error_saved = False
+                # Delete the problem keys all at once and store the report a single time.
+                try:
+                    self.shrink_report(report, memo)
+                    mongo_insert_one("analysis", report)
+                except InvalidDocument as e:
+                    if str(e).startswith("documents must have only string keys"):
+                        log.error("Search bug in your modifications - you got an dictionary key as int, should be string")
+                    log.error(str(e))
+                except Exception as e:
+                    log.error("Failed to delete child key: %s", e)
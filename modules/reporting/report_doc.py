@@ -6,7 +6,6 @@ import copy
 import logging
 import os
 import re
-from contextlib import suppress
 
 from lib.cuckoo.common.config import Config
 from lib.cuckoo.common.objects import File
@@ -19,7 +18,9 @@ CHUNK_CALL_SIZE = 100
 
 
 if repconf.mongodb.enabled:
-    from dev_utils.mongodb import mongo_insert_one
+    from pymongo.errors import DuplicateKeyError
+
+    from dev_utils.mongodb import UNACKNOWLEDGED, mongo_insert_many, mongo_insert_one
 elif repconf.elasticsearchdb.enabled:
     from elasticsearch.helpers import parallel_bulk
 
@@ -31,26 +32,33 @@ def ensure_valid_utf8(obj):
     required by MongoDB to be able to store the JSON documents.
     @param obj: analysis results dictionary.
     """
-    if not obj:
-        return
-
-    items = []
-    if isinstance(obj, dict):
-        items = obj.items()
-    elif isinstance(obj, list):
-        items = enumerate(obj)
-
-    for k, v in items:
-        # This type check is intentionally not done using isinstance(),
-        # because bson.binary.Binary *is* a subclass of bytes/str, and
-        # we do not want to convert that.
-        if isinstance(v, str):
-            try:
-                v.encode()
-            except UnicodeEncodeError:
-                obj[k] = "".join(str(ord(_)) for _ in v).encode()
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if not obj:
+            continue
+
+        if isinstance(obj, dict):
+            items = obj.items()
+        elif isinstance(obj, list):
+            items = enumerate(obj)
         else:
-            ensure_valid_utf8(v)
+            continue
+
+        for k, v in items:
+            # This type check is intentionally not done using isinstance(),
+            # because bson.binary.Binary *is* a subclass of bytes/str, and
+            # we do not want to convert that.
+            if isinstance(v, str):
+                # Most strings are plain ASCII, skip them without building a bytes copy.
+                if v.isascii():
+                    continue
+                try:
+                    v.encode()
+                except UnicodeEncodeError:
+                    obj[k] = "".join(str(ord(_)) for _ in v).encode()
+            elif isinstance(v, (dict, list)):
+                stack.append(v)
 
 
 def get_json_document(results, analysis_path):
@@ -100,6 +108,36 @@ def chunks(lst, n):
         yield lst[i : i + n]
 
 
+def insert_call_chunks(call_chunks):
+    """Store the call chunks in MongoDB with a single unordered bulk insert.
+    @param call_chunks: list of call chunk documents.
+    @return: list with the id of each chunk, None for the chunks that failed.
+    """
+    try:
+        # Unacknowledged, so server side errors are never reported back and only
+        # client side ones (encoding, connection) end up in the fallback below.
+        # pymongo refuses bypass_document_validation for those and "calls" has no validator.
+        return mongo_insert_many("calls", call_chunks, ordered=False, write_concern=UNACKNOWLEDGED).inserted_ids
+    except Exception as e:
+        log.warning("Failed to bulk insert calls, inserting them one by one: %s", e)
+
+    # The fallback is acknowledged on purpose: it has to tell which chunks got
+    # stored, and chunks already sent by the failed bulk insert come back as
+    # duplicate keys instead of being lost.
+    chunks_ids = []
+    for chunk in call_chunks:
+        chunk_id = None
+        try:
+            chunk_id = mongo_insert_one("calls", chunk).inserted_id
+        except DuplicateKeyError:
+            # Already written by the bulk insert before it failed.
+            chunk_id = chunk["_id"]
+        except Exception:
+            pass
+        chunks_ids.append(chunk_id)
+    return chunks_ids
+
+
 def insert_calls(report, elastic_db=None, mongodb=False):
     ## Behaviour envolves storing stuffs in the DB
     # Store chunks of API calls in a different collection and reference
@@ -107,38 +145,19 @@ def insert_calls(report, elastic_db=None, mongodb=False):
     # issue with the oversized reports exceeding MongoDB's boundaries.
     # Also allows paging of the reports.
     new_processes = []
+    # For mongoDB the chunks of all processes are stored at once, along with
+    # the chunks_ids list of the process each of them belongs to.
+    call_chunks = []
+    chunk_owners = []
     for process in report.get("behavior", {}).get("processes", []) or []:
         new_process = dict(process)
-        chunk = []
         chunks_ids = []
 
         # Upload for mongoDB
-        # Loop on each process call.
         if mongodb:
-            for _, call in enumerate(process["calls"]):
-                chunk_id = None
-                # If the chunk size is CHUNK_CALL_SIZE or if the loop is completed then store the chunk in DB.
-                if len(chunk) == CHUNK_CALL_SIZE:
-                    to_insert = {"pid": process["process_id"], "calls": chunk}
-                    with suppress(Exception):
-                        chunk_id = mongo_insert_one("calls", to_insert).inserted_id
-
-                    if chunk_id:
-                        chunks_ids.append(chunk_id)
-                    # Reset the chunk.
-                    chunk = []
-                # Append call to the chunk.
-                chunk.append(call)
-
-            # Store leftovers.
-            if chunk:
-                chunk_id = None
-                to_insert = {"pid": process["process_id"], "calls": chunk}
-                with suppress(Exception):
-                    chunk_id = mongo_insert_one("calls", to_insert).inserted_id
-
-                if chunk_id:
-                    chunks_ids.append(chunk_id)
+            for chunk in chunks(process["calls"], CHUNK_CALL_SIZE):
+                call_chunks.append({"pid": process["process_id"], "calls": chunk})
+                chunk_owners.append(chunks_ids)
 
         elif elastic_db is not None:
             # Upload with parallel bulk for elastic
@@ -158,4 +177,9 @@ def insert_calls(report, elastic_db=None, mongodb=False):
         new_process["calls"] = chunks_ids
         new_processes.append(new_process)
 
+    if call_chunks:
+        for chunks_ids, chunk_id in zip(chunk_owners, insert_call_chunks(call_chunks)):
+            if chunk_id:
+                chunks_ids.append(chunk_id)
+
     return new_processes
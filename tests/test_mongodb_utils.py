@@ -0,0 +1,62 @@
+import pytest
+from pymongo.write_concern import WriteConcern
+
+from dev_utils import mongo_hooks, mongodb
+from dev_utils.mongodb import mongo_delete_data
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """Fake mongo calls, recording the deletes and looking analyses up in db["analyses"]."""
+    db = {"analyses": [], "delete_many": [], "update_many": []}
+
+    def find(collection, query, projection=False, **kwargs):
+        return [analysis for analysis in db["analyses"] if analysis["info"]["id"] in query["info.id"]["$in"]]
+
+    def delete_many(collection, query, write_concern=None):
+        db["delete_many"].append((collection, query["_id"]["$in"], write_concern))
+
+    def update_many(collection, query, update):
+        db["update_many"].append((collection, query, update))
+
+    monkeypatch.setattr(mongodb, "mongo_find", find)
+    monkeypatch.setattr(mongodb, "mongo_delete_many", delete_many)
+    monkeypatch.setattr(mongo_hooks, "mongo_update_many", update_many)
+    return db
+
+
+def analysis(_id, task_id, *calls):
+    return {"_id": _id, "info": {"id": task_id}, "behavior": {"processes": [{"calls": c} for c in calls]}}
+
+
+class TestMongoDeleteData:
+    def test_nothing_to_delete(self, db):
+        assert mongo_delete_data(1) is False
+        assert not db["delete_many"]
+        assert not db["update_many"]
+
+    def test_deletes_all_in_one_request(self, db):
+        db["analyses"] = [analysis("a", 1, ["c1", "c2"], [], ["c3"]), analysis("b", 2, ["c4"]), analysis("c", 3, ["c5"])]
+        assert mongo_delete_data([1, 2]) is True
+        assert db["delete_many"] == [("calls", ["c1", "c2", "c3", "c4"], None), ("analysis", ["a", "b"], None)]
+        # The files references of the deleted tasks get removed by the hook.
+        assert db["update_many"][0][2] == {"$pullAll": {mongo_hooks.TASK_IDS_KEY: [1, 2]}}
+
+    def test_analysis_without_calls(self, db):
+        db["analyses"] = [{"_id": "a", "info": {"id": 1}}]
+        assert mongo_delete_data(1) is True
+        assert db["delete_many"] == [("analysis", ["a"], None)]
+
+    def test_calls_write_concern(self, db):
+        db["analyses"] = [analysis("a", 1, ["c1"])]
+        write_concern = WriteConcern(w=0)
+        assert mongo_delete_data(1, calls_write_concern=write_concern) is True
+        assert db["delete_many"] == [("calls", ["c1"], write_concern), ("analysis", ["a"], None)]
+
+    def test_errors_are_logged(self, db, monkeypatch, caplog):
+        def fail(*args, **kwargs):
+            raise ValueError("connection lost")
+
+        monkeypatch.setattr(mongodb, "mongo_find", fail)
+        assert mongo_delete_data(1) is False
+        assert "connection lost" in caplog.text
@@ -0,0 +1,99 @@
+import sys
+from types import SimpleNamespace
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+from modules.reporting import report_doc
+from modules.reporting.report_doc import CHUNK_CALL_SIZE, ensure_valid_utf8, insert_call_chunks, insert_calls
+
+
+class TestEnsureValidUtf8:
+    def test_keeps_valid_strings(self):
+        report = {"a": "ascii", "b": ["café", {"c": "中文"}], "d": 1, "e": None}
+        ensure_valid_utf8(report)
+        assert report == {"a": "ascii", "b": ["café", {"c": "中文"}], "d": 1, "e": None}
+
+    def test_replaces_surrogates(self):
+        report = {"a": "\ud800x", "b": [{"c": "\udc00"}]}
+        ensure_valid_utf8(report)
+        assert report == {"a": b"55296120", "b": [{"c": b"56320"}]}
+
+    def test_deep_nesting(self):
+        report = node = []
+        for _ in range(sys.getrecursionlimit() * 2):
+            node.append([])
+            node = node[0]
+        node.append("\ud800")
+        ensure_valid_utf8(report)
+        assert node == [b"55296"]
+
+
+def process(pid, calls):
+    return {"process_id": pid, "calls": list(range(calls))}
+
+
+class TestInsertCalls:
+    @pytest.fixture
+    def stored(self, monkeypatch):
+        """Records the chunks passed to insert_call_chunks and gives them ids 1, 2, ..."""
+        stored = []
+
+        def fake_insert_call_chunks(call_chunks):
+            stored.extend(call_chunks)
+            return list(range(1, len(call_chunks) + 1))
+
+        monkeypatch.setattr(report_doc, "insert_call_chunks", fake_insert_call_chunks)
+        return stored
+
+    def test_ids_go_back_to_their_process(self, stored):
+        report = {"behavior": {"processes": [process(10, CHUNK_CALL_SIZE * 2 + 1), process(20, 0), process(30, 1)]}}
+        new_processes = insert_calls(report, mongodb=True)
+        assert [p["calls"] for p in new_processes] == [[1, 2, 3], [], [4]]
+        assert [(chunk["pid"], len(chunk["calls"])) for chunk in stored] == [
+            (10, CHUNK_CALL_SIZE),
+            (10, CHUNK_CALL_SIZE),
+            (10, 1),
+            (30, 1),
+        ]
+        # The report itself is left untouched.
+        assert len(report["behavior"]["processes"][0]["calls"]) == CHUNK_CALL_SIZE * 2 + 1
+
+    def test_failed_chunks_are_dropped(self, monkeypatch):
+        monkeypatch.setattr(report_doc, "insert_call_chunks", lambda call_chunks: [None, "b", None, "d"])
+        report = {"behavior": {"processes": [process(10, CHUNK_CALL_SIZE + 1), process(20, CHUNK_CALL_SIZE * 2)]}}
+        assert [p["calls"] for p in insert_calls(report, mongodb=True)] == [["b"], ["d"]]
+
+    def test_no_processes(self, stored):
+        assert insert_calls({}, mongodb=True) == []
+        assert not stored
+
+
+class TestInsertCallChunks:
+    @pytest.fixture(autouse=True)
+    def mongo(self, monkeypatch):
+        # report_doc only imports these when mongodb is enabled in reporting.conf.
+        monkeypatch.setattr(report_doc, "UNACKNOWLEDGED", object(), raising=False)
+        monkeypatch.setattr(report_doc, "DuplicateKeyError", DuplicateKeyError, raising=False)
+
+    def test_bulk_insert(self, monkeypatch):
+        monkeypatch.setattr(
+            report_doc, "mongo_insert_many", lambda *args, **kwargs: SimpleNamespace(inserted_ids=[1, 2]), raising=False
+        )
+        assert insert_call_chunks([{}, {}]) == [1, 2]
+
+    def test_fallback_one_by_one(self, monkeypatch):
+        def fail(*args, **kwargs):
+            raise ValueError("bulk insert failed")
+
+        def insert_one(collection, chunk):
+            if chunk["calls"] == "sent":
+                raise DuplicateKeyError("already stored")
+            if chunk["calls"] == "bad":
+                raise ValueError("can't store")
+            return SimpleNamespace(inserted_id=chunk["_id"])
+
+        monkeypatch.setattr(report_doc, "mongo_insert_many", fail, raising=False)
+        monkeypatch.setattr(report_doc, "mongo_insert_one", insert_one, raising=False)
+        chunks = [{"_id": 1, "calls": "new"}, {"_id": 2, "calls": "sent"}, {"_id": 3, "calls": "bad"}]
+        assert insert_call_chunks(chunks) == [1, 2, None]
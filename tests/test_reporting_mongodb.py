@@ -0,0 +1,219 @@
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import bson
+import pytest
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DocumentTooLarge, InvalidDocument
+
+from modules.reporting import mongodb
+from modules.reporting.mongodb import MongoDB
+
+
+def bson_size(report):
+    return len(bson.encode(report))
+
+
+def nested(depth, leaf):
+    """Builds {"k": {"k": ... {"k": leaf}}}, nested depth levels deep."""
+    root = node = {}
+    for _ in range(depth):
+        node["k"] = {}
+        node = node["k"]
+    node["k"] = leaf
+    return root
+
+
+@pytest.fixture
+def size_limit(monkeypatch):
+    limit = 0x1000
+    monkeypatch.setattr(mongodb, "MONGOSIZELIMIT", limit)
+    return limit
+
+
+class TestShrinkReport:
+    def test_fits_without_changes(self, size_limit):
+        report = {"info": {"id": 1}, "behavior": {"summary": "a" * 16}}
+        MongoDB().shrink_report(report, {})
+        assert report == {"info": {"id": 1}, "behavior": {"summary": "a" * 16}}
+
+    def test_shrinks_under_limit(self, size_limit):
+        report = {
+            "info": {"id": 1, "machine": "m" * 3000},
+            "strings": ["s" * 2000],
+            "behavior": {"summary": "a" * 3000, "small": "b"},
+            "dropped": [{"data": "d" * 2000, "name": "n"}],
+        }
+        assert bson_size(report) > size_limit
+        MongoDB().shrink_report(report, {})
+        assert bson_size(report) <= size_limit
+        assert report["info"] == {"id": 1, "machine": "m" * 3000}
+        # Only the largest children get deleted.
+        assert report["behavior"] == {"small": "b"}
+        assert report["dropped"] == [{"name": "n"}]
+        assert "strings" not in report
+
+    def test_never_deletes_info(self, size_limit):
+        report = {"info": {"id": 1, "machine": "m" * 8000}, "behavior": {"summary": "a"}}
+        MongoDB().shrink_report(report, {})
+        assert report["info"] == {"id": 1, "machine": "m" * 8000}
+
+    def test_shared_dicts(self, size_limit):
+        shared = {"data": "d" * 1000, "name": "n"}
+        report = {"info": {"id": 1}, "procmemory": [shared, shared, shared, shared, shared]}
+        MongoDB().shrink_report(report, {})
+        assert bson_size(report) <= size_limit
+        # The same dict is only planned for deletion once.
+        assert "data" not in shared
+        assert all(entry is shared for entry in report["procmemory"])
+
+
+class TestFixInt2Str:
+    def test_renames_int_keys(self):
+        report = {1: "a", "b": {2: {3: "c"}}}
+        MongoDB().fix_int2str(report)
+        assert report == {"1": "a", "b": {"2": {"3": "c"}}}
+
+    def test_renames_int_keys_in_lists(self):
+        report = {"processes": [{1: "a"}, "not a dict", {"calls": [{2: "b"}]}]}
+        MongoDB().fix_int2str(report)
+        assert report == {"processes": [{"1": "a"}, "not a dict", {"calls": [{"2": "b"}]}]}
+
+    def test_logs_key_tree(self, caplog):
+        MongoDB().fix_int2str({"a": [{"b": {4: "c"}}]})
+        assert "BAD KEY: .a.b.4" in caplog.text
+
+    def test_deep_nesting(self):
+        report = nested(sys.getrecursionlimit() * 2, {5: "x"})
+        MongoDB().fix_int2str(report)
+        node = report
+        while "k" in node:
+            node = node["k"]
+        assert node == {"5": "x"}
+
+
+class TestSizeOf:
+    def test_counts_strings_only(self):
+        assert mongodb._size_of("abc", {}) == 3
+        assert mongodb._size_of(42, {}) == 0
+        assert mongodb._size_of({"a": "bc", "d": [1, "ef", ("g",), {"h"}], "i": None}, {}) == 6
+
+    def test_memoizes_containers(self):
+        child = {"a": "bcd"}
+        memo = {}
+        assert mongodb._size_of([child, child], memo) == 6
+        assert memo[id(child)] == 3
+        # Cached sizes are served without walking again.
+        memo[id(child)] = 10
+        assert mongodb._size_of(child, memo) == 10
+
+    def test_deep_nesting(self):
+        assert mongodb._size_of(nested(sys.getrecursionlimit() * 2, "xyz"), {}) == 3
+
+    def test_debug_dict_size(self):
+        report = {"info": {"id": 1}, "behavior": {"a": "b" * 10}, "strings": ["c" * 5], "shots": []}
+        assert MongoDB().debug_dict_size(report) == [("behavior", 10), ("strings", 5), ("info", 0), ("shots", 0)]
+
+
+class TestLoopSaver:
+    @pytest.fixture
+    def db(self, monkeypatch):
+        """Fake analysis collection, failing writes of the keys listed in db.bad_keys."""
+        db = SimpleNamespace(inserted=[], bulk_writes=[], bad_keys=set(), insert_error=None, bulk_error=None)
+
+        def insert_one(collection, doc):
+            if db.insert_error and len(doc) > 1:
+                raise db.insert_error
+            db.inserted.append(dict(doc))
+            return SimpleNamespace(inserted_id="obj_id")
+
+        def bulk_write(collection, requests, **kwargs):
+            db.bulk_writes.append(requests)
+            if db.bulk_error and len(requests) > 1:
+                raise db.bulk_error
+            errors = [
+                {"index": i, "errmsg": "failed"} for i, request in enumerate(requests) if set(request._doc["$set"]) & db.bad_keys
+            ]
+            if errors:
+                raise BulkWriteError({"writeErrors": errors})
+
+        monkeypatch.setattr(mongodb, "mongo_insert_one", insert_one)
+        monkeypatch.setattr(mongodb, "mongo_bulk_write", bulk_write)
+        return db
+
+    def test_single_insert(self, db):
+        MongoDB().loop_saver({"_id": "old", "info": {"id": 1}, "behavior": {}, "network": {}})
+        assert db.inserted == [{"info": {"id": 1}, "behavior": {}, "network": {}}]
+        assert not db.bulk_writes
+
+    def test_skips_unencodable_key(self, db, caplog):
+        MongoDB().loop_saver({"info": {"id": 1}, "bad": object(), "network": {}})
+        assert db.inserted == [{"info": {"id": 1}, "network": {}}]
+        assert "Investigate your key: bad" in caplog.text
+
+    def test_missing_info(self, db, caplog):
+        MongoDB().loop_saver({"network": {}})
+        assert not db.inserted
+        assert "Missing 'info' key" in caplog.text
+
+    def test_bulk_fallback_logs_key_errors(self, db, caplog):
+        db.insert_error = InvalidDocument("document too large")
+        db.bad_keys = {"behavior"}
+        MongoDB().loop_saver({"info": {"id": 1}, "behavior": {}, "network": {}})
+        assert db.inserted == [{"info": {"id": 1}}]
+        assert db.bulk_writes == [
+            [UpdateOne({"_id": "obj_id"}, {"$set": {"behavior": {}}}), UpdateOne({"_id": "obj_id"}, {"$set": {"network": {}}})]
+        ]
+        assert "Investigate your key: behavior" in caplog.text
+        assert "Investigate your key: network" not in caplog.text
+
+    def test_bulk_fallback_invalid_document(self, db, caplog):
+        db.insert_error = InvalidDocument("document too large")
+        db.bulk_error = DocumentTooLarge("operation too large")
+        db.bad_keys = {"network"}
+        MongoDB().loop_saver({"info": {"id": 1}, "behavior": {}, "network": {}})
+        # The whole batch is refused, then every key is written on its own.
+        assert len(db.bulk_writes) == 3
+        assert "Investigate your key: network" in caplog.text
+        assert "Investigate your key: behavior" not in caplog.text
+
+
+class TestRun:
+    def test_deletes_while_storing_calls(self, monkeypatch, tmp_path):
+        events = []
+        calls_started = threading.Event()
+
+        def delete_data(task_id, calls_write_concern=None):
+            # Only returns once insert_calls runs, so both have to overlap.
+            overlapped = calls_started.wait(timeout=5)
+            events.append(("delete", task_id, calls_write_concern, overlapped))
+            return True
+
+        def insert_calls(report, mongodb=False):
+            calls_started.set()
+            time.sleep(0.05)
+            events.append(("insert_calls",))
+            return [{"process_id": 1, "calls": ["chunk_id"]}]
+
+        def insert_one(collection, doc):
+            events.append(("insert_one", collection, doc["info"]["id"], doc["behavior"]["processes"]))
+
+        monkeypatch.setattr(MongoDB, "_initialized", True)
+        monkeypatch.setattr(mongodb, "mongo_delete_data", delete_data)
+        monkeypatch.setattr(mongodb, "insert_calls", insert_calls)
+        monkeypatch.setattr(mongodb, "mongo_insert_one", insert_one)
+
+        results = {
+            "info": {"id": 5, "options": {"main_task_id": "7"}},
+            "behavior": {"processes": [{"process_id": 1, "calls": [{"api": "NtClose"}]}]},
+        }
+        reporter = MongoDB()
+        reporter.set_path(str(tmp_path))
+        reporter.run(results)
+
+        assert sorted(events[:2]) == [("delete", 7, mongodb.UNACKNOWLEDGED, True), ("insert_calls",)]
+        assert events[2:] == [("insert_one", "analysis", 7, [{"process_id": 1, "calls": ["chunk_id"]}])]
+        # The results dict of the other reporting modules is left alone.
+        assert results["info"]["id"] == 5